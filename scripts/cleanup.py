@@ -2,33 +2,37 @@
 
 import sys
 import json
-import collections
+import orjson
 
-obj = json.load(sys.stdin)
+obj = orjson.loads(sys.stdin.buffer.read())
 
 
-id_counts = collections.defaultdict(lambda: 1)
+id_counts = {}
 
 def convert(obj):
     sprites = obj["sprites"]
+    tile_size = obj["tileSize"]
 
     tiles = []
     for sprite in sprites:
 
         sprite_id = sprite['id'].replace("_", "-")
-        id_count = id_counts[sprite_id]
-        id_counts[sprite_id] += 1
+        id_count = id_counts.get(sprite_id, 0) + 1
+        id_counts[sprite_id] = id_count
+
+        col = sprite["gridX"]
+        row = sprite["gridY"]
 
         tile ={
           "id": f"{sprite_id}-{id_count}",
           "page": "dungeon",
           "name": sprite["name"],
-          "row": sprite["gridY"],
-          "col": sprite["gridX"],
-          "x": sprite["gridX"] * obj["tileSize"],
-          "y": sprite["gridY"] * obj["tileSize"],
-          "w": obj["tileSize"],
-          "h": obj["tileSize"],
+          "row": row,
+          "col": col,
+          "x": col * tile_size,
+          "y": row * tile_size,
+          "w": tile_size,
+          "h": tile_size,
           "type": sprite["type"],
           "walkable": sprite["walkable"],
           "description": sprite["description"],
@@ -37,8 +41,8 @@ def convert(obj):
 
     rv = {
         "meta": {
-            "tileWidth": obj["tileSize"],
-            "tileHeight": obj["tileSize"],
+            "tileWidth": tile_size,
+            "tileHeight": tile_size,
             "origin": "top-left",
             "pages": [
                 {
@@ -58,4 +62,5 @@ def convert(obj):
 
 rv = convert(obj)
 
+# Serialize with the stdlib so the checked-in manifest format is unchanged
 json.dump(rv, sys.stdout)
\ No newline at end of file
@@ -2,6 +2,7 @@
 
 import sys
 import json
+import orjson
 import collections
 
 id_counts = collections.defaultdict(lambda: 1)
@@ -16,6 +17,7 @@ def convert(tileset):
         tile["id"] = f"{tile_id}-{id_count}"
 
 
-obj = json.load(sys.stdin)
+obj = orjson.loads(sys.stdin.buffer.read())
 convert(obj)
+# Serialize with the stdlib so the checked-in manifest format is unchanged
 json.dump(obj, sys.stdout)
\ No newline at end of file
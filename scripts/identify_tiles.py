@@ -6,7 +6,19 @@ This script analyzes a tileset image and uses Claude's vision API to identify
 each sprite, generating a JSON manifest with names, descriptions, and metadata.
 
 Usage:
-    python identify_tiles.py tileset_config.yaml
+    python identify_tiles.py tileset_config.yaml [--batch] [--debug-dump] [--upload-files]
+
+With --batch all tiles are submitted as a single Message Batches job, which
+costs half as much but can take a while to complete; if the run is interrupted,
+the next --batch run re-attaches to the submitted batch. --debug-dump writes
+each non-empty tile to tiles/ for inspection. --upload-files uploads tiles
+through the Files API and references them by ID rather than inlining them as
+base64.
+
+Identifications are cached in cache/ keyed by a hash of the tile pixels, the
+model and the prompt, so re-runs only pay for tiles (or prompts) that changed.
+While running, identified sprites are appended to sprites.ndjson; if the
+script is interrupted, the next run picks up where it left off.
 
 The YAML config should contain:
     image: path/to/tileset.png
@@ -14,117 +26,566 @@ The YAML config should contain:
     gridWidth: 16   # number of tiles horizontally
     gridHeight: 16  # number of tiles vertically
 
+Requests are multiplexed over HTTP/2 when the httpx[http2] extra (the h2
+package) is installed, and fall back to HTTP/1.1 otherwise.
+
+Environment:
+    CONCURRENCY - maximum number of in-flight API requests (default: 8)
+
 Output:
     sprites.json - JSON manifest with sprite metadata
 """
 
-import sys
+import os
+import argparse
 import yaml
 import json
+import math
 import base64
+import hashlib
+import importlib.util
+import asyncio
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from PIL import Image
-from anthropic import Anthropic
+import anthropic
+from anthropic import AsyncAnthropic
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_combine, wait_random_exponential
+
+# Numba is optional; without it the tile scan falls back to plain NumPy
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# h2 enables HTTP/2 (pip install 'httpx[http2]'); without it requests use HTTP/1.1
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# Identifications keyed by tile pixel hash, reused across runs
+CACHE_DIR = Path("cache")
+
+# ID and requests of a submitted batch whose results have not been collected yet
+BATCH_PATH = Path("sprites.batch")
+
+# Sprites are appended here as they are identified so an interrupted run can resume
+PROGRESS_PATH = Path("sprites.ndjson")
 
 def load_config(config_path: str) -> dict:
     """Load tileset configuration from YAML file."""
     with open(config_path, 'r') as f:
         return yaml.safe_load(f)
 
-def extract_tile(image: Image.Image, x: int, y: int, tile_size: int) -> Image.Image:
-    """Extract a single tile from the tileset."""
+def extract_tile(full: np.ndarray, x: int, y: int, tile_size: int) -> np.ndarray:
+    """Extract a single tile from the tileset as a view into the pixel array."""
     left = x * tile_size
     top = y * tile_size
-    right = left + tile_size
-    bottom = top + tile_size
-    return image.crop((left, top, right, bottom))
-
-def is_empty_tile(tile: Image.Image, threshold: int = 10) -> bool:
-    """Check if a tile is mostly empty/transparent."""
-    if tile.mode != 'RGBA':
-        tile = tile.convert('RGBA')
-
-    # Count non-transparent pixels
-    pixels = list(tile.getdata())
-    non_transparent = sum(1 for _, _, _, a in pixels if a > threshold)
+    return full[top:top + tile_size, left:left + tile_size]
+
+def pad_to_grid(full: np.ndarray, tile_size: int, grid_width: int, grid_height: int) -> np.ndarray:
+    """Pad the tileset with transparent pixels so it covers the whole grid.
+
+    Tiles that fall partly or wholly outside the image come out transparent,
+    as they did when tiles were cropped with PIL.
+    """
+    pad_y = max(0, grid_height * tile_size - full.shape[0])
+    pad_x = max(0, grid_width * tile_size - full.shape[1])
+    if pad_y or pad_x:
+        full = np.pad(full, ((0, pad_y), (0, pad_x), (0, 0)))
+    return full
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def count_visible_pixels(full, tile_size, grid_width, grid_height, threshold, limit):
+        """Count pixels with alpha above threshold in each tile, one parallel pass over the image.
+
+        Counting stops once a tile reaches `limit` visible pixels, so counts are
+        capped there; beyond that the tile is known not to be empty.
+        """
+        visible = np.zeros((grid_height, grid_width), dtype=np.int32)
+        for y in prange(grid_height):
+            for x in range(grid_width):
+                count = 0
+                for j in range(y * tile_size, (y + 1) * tile_size):
+                    for i in range(x * tile_size, (x + 1) * tile_size):
+                        if full[j, i, 3] > threshold:
+                            count += 1
+                    if count >= limit:
+                        break
+                visible[y, x] = count
+        return visible
+
+def find_empty_tiles(full: np.ndarray, tile_size: int, grid_width: int, grid_height: int,
+                     threshold: int = 10) -> np.ndarray:
+    """Return a (grid_height, grid_width) mask of tiles that are mostly empty/transparent."""
+    if full.shape[0] < grid_height * tile_size or full.shape[1] < grid_width * tile_size:
+        raise ValueError(f"tileset is {full.shape[1]}x{full.shape[0]}, smaller than the "
+                         f"{grid_width}x{grid_height} grid of {tile_size}px tiles")
 
     # Consider empty if less than 5% of pixels are visible
-    return non_transparent < (len(pixels) * 0.05)
-
-def encode_image_base64(tile: Image.Image) -> str:
-    """Encode a PIL Image as base64 PNG."""
+    limit = tile_size * tile_size * 0.05
+
+    # Count non-transparent pixels per tile
+    if njit is not None:
+        visible = count_visible_pixels(full, tile_size, grid_width, grid_height, threshold, math.ceil(limit))
+    else:
+        # View the alpha channel as (row, col, tile pixel y, tile pixel x)
+        alpha = full[:grid_height * tile_size, :grid_width * tile_size, 3]
+        alpha = alpha.reshape(grid_height, tile_size, grid_width, tile_size).transpose(0, 2, 1, 3)
+        visible = (alpha > threshold).sum(axis=(2, 3))
+
+    return visible < limit
+
+def save_tile(tile: np.ndarray, path: str):
+    """Write a tile to disk as PNG."""
+    Image.fromarray(tile).save(path)
+
+def encode_image(tile: Image.Image, max_colors: int = 64) -> tuple[str, bytes]:
+    """Encode a PIL Image as lossless WebP, returning (media_type, data).
+
+    Tiles with more than `max_colors` distinct colors are quantized to an
+    adaptive palette first, which shrinks shaded sprites several times over
+    without losing anything Claude needs to classify them.
+    """
     from io import BytesIO
     buffer = BytesIO()
-    tile.save(buffer, format='PNG')
-    return base64.b64encode(buffer.getvalue()).decode('utf-8')
-
-def identify_sprite(client: Anthropic, tile: Image.Image, grid_x: int, grid_y: int) -> dict:
-    """Use Claude's vision API to identify and describe a sprite."""
-
-    # Encode tile as base64
-    image_data = encode_image_base64(tile)
-
-    # Create prompt for Claude
-    prompt = f"""Analyze this 64x64 pixel sprite from a roguelike game tileset (position: row {grid_y}, col {grid_x}).
-
-Please provide:
-1. A short descriptive ID (lowercase, underscores, e.g., "stone_wall", "wooden_door", "grass_floor")
-2. A brief name (e.g., "Stone Wall", "Wooden Door", "Grass Floor")
-3. A one-sentence description
-4. The type (choose one: "floor", "wall", "door", "decoration", "character", "item", "other")
-5. Whether it's walkable (true/false)
-
-Respond ONLY with a JSON object in this exact format:
-{{
-  "id": "descriptive_id",
-  "name": "Display Name",
-  "description": "Brief description of the sprite.",
-  "type": "floor",
-  "walkable": true
-}}"""
-
-    # Call Claude API
-    message = client.messages.create(
-        model="claude-sonnet-4-5",
-        max_tokens=1024,
-        messages=[
+    if tile.getcolors(max_colors) is None:
+        tile = tile.quantize(colors=max_colors, method=Image.Quantize.FASTOCTREE,
+                             dither=Image.Dither.NONE).convert('RGBA')
+    tile.save(buffer, format='WEBP', lossless=True, quality=100, method=0)
+    return "image/webp", buffer.getvalue()
+
+def encode_image_base64(tile: Image.Image) -> tuple[str, str]:
+    """Encode a PIL Image as base64 lossless WebP, returning (media_type, data)."""
+    media_type, data = encode_image(tile)
+    return media_type, base64.b64encode(data).decode('utf-8')
+
+# Beta flag required to upload and reference files
+FILES_BETA = "files-api-2025-04-14"
+
+def is_transient_error(error: BaseException) -> bool:
+    """Errors worth retrying: rate limits, any 5xx (including 529 overloaded) and dropped connections."""
+    if isinstance(error, anthropic.APIConnectionError):
+        return True
+    return isinstance(error, anthropic.APIStatusError) and (error.status_code == 429 or error.status_code >= 500)
+
+def wait_retry_after(retry_state) -> float:
+    """Honor the retry-after header the API sends with 429 responses."""
+    error = retry_state.outcome.exception()
+    if isinstance(error, anthropic.RateLimitError):
+        try:
+            return float(error.response.headers.get("retry-after", 0))
+        except ValueError:
+            return 0
+    return 0
+
+# Structured output schema; Claude fills this in instead of free-form JSON
+SPRITE_TOOL = {
+    "name": "record_sprite",
+    "description": "Record the identification of a roguelike tileset sprite.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "id": {
+                "type": "string",
+                "description": 'Short descriptive ID, lowercase with underscores, e.g. "stone_wall"',
+            },
+            "name": {
+                "type": "string",
+                "description": 'Display name, e.g. "Stone Wall"',
+            },
+            "description": {
+                "type": "string",
+                "description": "One-sentence description of the sprite",
+            },
+            "type": {
+                "type": "string",
+                "enum": ["floor", "wall", "door", "decoration", "character", "item", "other"],
+            },
+            "walkable": {
+                "type": "boolean",
+                "description": "Whether a character can walk over this tile",
+            },
+        },
+        "required": ["id", "name", "description", "type", "walkable"],
+    },
+}
+
+# Task instructions shared by every request. Together with SPRITE_TOOL this is a
+# stable prefix, so it is marked for prompt caching. A prefix is only cached once it
+# reaches 1024 tokens, which this guide and the tool definition together exceed.
+INSTRUCTIONS = """You are cataloguing the sprites of a tileset for a top-down 2D roguelike action RPG in the style of The Legend of Zelda. Each request shows you one sprite cut from a regular grid on the tileset sheet, along with its row and column on that grid. Look at the sprite and record what it depicts by calling the record_sprite tool exactly once. The results become the sprite manifest the game client and map tools use to look up tiles, so consistency across the whole sheet matters more than flourish.
+
+ID
+- Lowercase words separated by underscores, using only a-z, 0-9 and _.
+- Lead with the material or subject and end with the kind of thing: "stone_wall", "wooden_door", "grass_floor", "iron_key", "skeleton_warrior".
+- Add a distinguishing qualifier for variants of the same thing rather than a number: "stone_wall_cracked", "stone_wall_corner_top_left", "wooden_door_open", "torch_lit".
+- Directional pieces (wall edges, corners, path bends, cliff sides) name the side or corner they occupy: "_top", "_bottom_right", "_inner_corner_top_left".
+- Do not include the grid position, the tileset name or generic words like "tile" or "sprite" in the ID. Identical-looking sprites must get identical IDs; the manifest tooling numbers duplicates itself.
+
+Name
+- The same concept as the ID in Title Case with spaces: "Stone Wall", "Wooden Door (Open)", "Stone Wall Corner (Top Left)".
+- Keep it under about five words.
+
+Description
+- One plain sentence describing what is visible: materials, colours, notable details, and state such as open, broken, lit or empty.
+- Do not speculate about gameplay or lore beyond what is drawn.
+
+Type (choose exactly one)
+- floor: ground surfaces the player stands on: dirt, grass, sand, flagstones, planks, carpet, shallow puddles, floor variants with cracks, moss or debris, stairs and ladders drawn as ground tiles.
+- wall: anything that blocks movement and forms the structure of a map: walls and wall edges, corners and tops, cliffs, rock faces, pillars that fill the tile, fences, deep water, lava and chasms.
+- door: passable or lockable openings between areas: doors in any state, gates, portcullises, archways, trapdoors, stair entrances and exits.
+- decoration: scenery placed on top of floors or walls that is not picked up: furniture, barrels, crates, chests, statues, plants, bones, banners, torches, windows, rugs, altars, fountains.
+- character: any creature or person: player characters, NPCs, monsters, animals, bosses, including single animation frames and corpses of creatures.
+- item: objects a player could pick up or equip: weapons, armour, shields, potions, scrolls, keys, coins, gems, food, rings, wands and other loot icons.
+- other: UI elements, effects (fire, smoke, magic, projectiles, explosions), text or numbers, selection cursors, and anything that does not fit the categories above.
+
+When a sprite could fit more than one type, prefer the one that describes how it would be used on a map: a chest is decoration even though it holds items, a torch on a wall bracket is decoration, a sword lying on its own is an item, and a doorway carved into a wall is a door.
+
+Walkable
+- true when a character could move onto the tile: floors, open doors and gates, archways, stairs, rugs, flat decorations such as scattered bones or blood splatters, items, and effects.
+- false when the tile blocks movement: walls, cliffs, deep water, lava, chasms, closed or locked doors and gates, furniture, barrels, crates, chests, statues, large plants, fountains, and characters.
+- If the sprite is ambiguous, choose false.
+
+Partial and odd sprites
+- Tilesets often split large objects across several grid cells. Identify the piece as part of the whole and say which part it is: "tree_top_left", "large_door_bottom".
+- Sprites with a small subject on a transparent background are still valid; describe the subject, not the empty space.
+- If a sprite is truly unrecognisable, use type "other", an ID describing what is visible such as "red_pattern", and walkable false."""
+
+MODEL = "claude-sonnet-4-5"
+
+# Identifies the model and prompt; cached identifications made with a different
+# model, instructions or schema must not be reused
+PROMPT_FINGERPRINT = hashlib.sha256(
+    json.dumps([MODEL, INSTRUCTIONS, SPRITE_TOOL], sort_keys=True).encode('utf-8')
+).hexdigest()
+
+def build_message_params(tile: np.ndarray, grid_x: int, grid_y: int, file_id: str | None = None) -> dict:
+    """Build the Messages API parameters asking Claude to describe a sprite.
+
+    If `file_id` is given the image is referenced from the Files API instead
+    of being sent inline as base64.
+    """
+    if file_id is None:
+        # Encode tile as base64
+        media_type, image_data = encode_image_base64(Image.fromarray(tile))
+        source = {
+            "type": "base64",
+            "media_type": media_type,
+            "data": image_data,
+        }
+    else:
+        source = {
+            "type": "file",
+            "file_id": file_id,
+        }
+
+    params = {
+        "model": MODEL,
+        "max_tokens": 1024,
+        "tools": [SPRITE_TOOL],
+        "tool_choice": {"type": "tool", "name": SPRITE_TOOL["name"]},
+        "system": [
+            {
+                "type": "text",
+                "text": INSTRUCTIONS,
+                "cache_control": {"type": "ephemeral"},
+            }
+        ],
+        "messages": [
             {
                 "role": "user",
                 "content": [
                     {
                         "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": "image/png",
-                            "data": image_data,
-                        },
+                        "source": source,
                     },
                     {
                         "type": "text",
-                        "text": prompt
+                        "text": f"Identify this roguelike tileset sprite at row {grid_y}, col {grid_x}."
                     }
                 ],
             }
         ],
+    }
+    if file_id is not None:
+        params["betas"] = [FILES_BETA]
+    return params
+
+def parse_sprite(message) -> dict:
+    """Extract the sprite fields from Claude's record_sprite tool call."""
+    for block in message.content:
+        if block.type == "tool_use" and block.name == SPRITE_TOOL["name"]:
+            sprite_data = dict(block.input)
+
+            # Forced tool use does not guarantee required fields are filled in
+            missing = [field for field in SPRITE_TOOL["input_schema"]["required"] if field not in sprite_data]
+            if missing:
+                raise ValueError(f"{SPRITE_TOOL['name']} call is missing {', '.join(missing)}")
+            return sprite_data
+    raise ValueError(f"No {SPRITE_TOOL['name']} tool call in response")
+
+retry_transient = retry(
+    retry=retry_if_exception(is_transient_error),
+    wait=wait_combine(wait_retry_after, wait_random_exponential(multiplier=2, max=60)),
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+
+@retry_transient
+async def identify_sprite(client: AsyncAnthropic, params: dict) -> dict:
+    """Use Claude's vision API to identify and describe a sprite."""
+    # File references are only accepted by the beta Messages endpoint
+    messages = client.beta.messages if "betas" in params else client.messages
+    message = await messages.create(**params)
+    return parse_sprite(message)
+
+@retry_transient
+async def upload_tile(client: AsyncAnthropic, tile: np.ndarray, grid_x: int, grid_y: int) -> str:
+    """Upload a tile through the Files API, returning its file ID."""
+    media_type, data = await asyncio.to_thread(encode_image, Image.fromarray(tile))
+    uploaded = await client.beta.files.upload(
+        file=(f"tile_{grid_y}_{grid_x}.webp", data, media_type),
+        betas=[FILES_BETA],
     )
+    return uploaded.id
+
+async def identify_uploaded_sprite(client: AsyncAnthropic, tile: np.ndarray, grid_x: int, grid_y: int) -> dict:
+    """Identify a sprite by uploading it and referencing it by file ID."""
+    file_id = await upload_tile(client, tile, grid_x, grid_y)
+    try:
+        return await identify_sprite(client, build_message_params(tile, grid_x, grid_y, file_id))
+    finally:
+        try:
+            await client.beta.files.delete(file_id, betas=[FILES_BETA])
+        except anthropic.APIError as e:
+            print(f"   ⚠ Could not delete uploaded file {file_id}: {e}")
+
+def failed_sprite(x: int, y: int, tile_num: int) -> dict:
+    """Placeholder manifest entry for a tile that could not be identified."""
+    return {
+        "id": f"tile_{y}_{x}",
+        "name": f"Tile {tile_num}",
+        "description": "Failed to identify",
+        "type": "other",
+        "walkable": False,
+        "gridX": x,
+        "gridY": y
+    }
+
+def tile_cache_key(tile: np.ndarray) -> str:
+    """Hash of a tile's pixels and the prompt fingerprint, used as the response cache key."""
+    digest = hashlib.sha256(PROMPT_FINGERPRINT.encode('utf-8'))
+    digest.update(tile.tobytes())
+    return digest.hexdigest()
+
+def load_cached_sprite(key: str) -> dict | None:
+    """Return the cached identification for a tile hash, if any."""
+    path = CACHE_DIR / f"{key}.json"
+    if not path.exists():
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_cached_sprite(key: str, sprite_data: dict):
+    """Cache a successful identification under the tile hash."""
+    CACHE_DIR.mkdir(exist_ok=True)
+    with open(CACHE_DIR / f"{key}.json", 'w') as f:
+        json.dump(sprite_data, f)
+
+def load_progress() -> dict:
+    """Load sprites recorded by an interrupted run, keyed by (gridX, gridY).
+
+    Each record carries the tileKey of the tile it was identified from so it
+    can be checked against the current tileset before being reused.
+    """
+    done = {}
+    if not PROGRESS_PATH.exists():
+        return done
+
+    truncated = False
+    with open(PROGRESS_PATH, 'r') as f:
+        for line in f:
+            try:
+                sprite_data = json.loads(line)
+            except json.JSONDecodeError:
+                # A crash can leave a truncated last line
+                truncated = True
+                continue
+            done[(sprite_data['gridX'], sprite_data['gridY'])] = sprite_data
+
+    if truncated:
+        # Rewrite without the broken line so new records are appended cleanly
+        with open(PROGRESS_PATH, 'w') as f:
+            for sprite_data in done.values():
+                f.write(json.dumps(sprite_data) + '\n')
+
+    return done
+
+async def identify_all(client: AsyncAnthropic, pending: list, grid_width: int,
+                       total_tiles: int, concurrency: int, on_identified,
+                       upload_files: bool = False) -> list:
+    """Identify all pending tiles with at most `concurrency` requests in flight.
+
+    `on_identified(index, sprite_data)` is called as each tile succeeds. With
+    `upload_files` tiles are sent through the Files API rather than inline.
+    Returns the sprite data in the same order as `pending`, with None for
+    tiles that failed to identify.
+    """
+    sem = asyncio.Semaphore(concurrency)
+    sprites = [None] * len(pending)
+
+    async def worker(index: int, x: int, y: int, tile: np.ndarray):
+        tile_num = y * grid_width + x
+        try:
+            if upload_files:
+                async with sem:
+                    sprite_data = await identify_uploaded_sprite(client, tile, x, y)
+            else:
+                # Encode in a worker thread before taking a slot so it overlaps requests in flight
+                params = await asyncio.to_thread(build_message_params, tile, x, y)
+                async with sem:
+                    sprite_data = await identify_sprite(client, params)
+            on_identified(index, sprite_data)
+            print(f"   [{tile_num + 1}/{total_tiles}] ({x}, {y}) ✓ {sprite_data['id']}")
+
+            # Only count the tile as identified once it has been recorded
+            sprites[index] = sprite_data
+        except Exception as e:
+            print(f"   [{tile_num + 1}/{total_tiles}] ({x}, {y}) ✗ Error: {e}")
+
+    await asyncio.gather(*[worker(i, x, y, tile) for i, (x, y, tile) in enumerate(pending)])
+    return sprites
+
+@retry_transient
+async def create_batch(client: AsyncAnthropic, requests: list):
+    """Submit a Message Batches job."""
+    return await client.messages.batches.create(requests=requests)
+
+@retry_transient
+async def retrieve_batch(client: AsyncAnthropic, batch_id: str):
+    """Fetch the current state of a Message Batches job."""
+    return await client.messages.batches.retrieve(batch_id)
+
+@retry_transient
+async def fetch_batch_results(client: AsyncAnthropic, batch_id: str) -> dict:
+    """Download the results of an ended batch, keyed by custom_id."""
+    results = {}
+    async for result in await client.messages.batches.results(batch_id):
+        results[result.custom_id] = result.result
+    return results
+
+def load_batch_id(request_keys: dict) -> str | None:
+    """Return the ID of a previously submitted batch made for exactly these requests.
+
+    A batch recorded for different tiles, grid or prompt is discarded.
+    """
+    if not BATCH_PATH.exists():
+        return None
+
+    try:
+        with open(BATCH_PATH, 'r') as f:
+            state = json.load(f)
+        batch_id = state["batchId"]
+        matches = state["requests"] == request_keys
+    except (json.JSONDecodeError, KeyError, TypeError):
+        batch_id, matches = None, False
+
+    if not matches:
+        print("   ⚠ Discarding recorded batch, it was submitted for different tiles")
+        BATCH_PATH.unlink()
+        return None
+    return batch_id
+
+async def identify_batch(client: AsyncAnthropic, pending: list, grid_width: int,
+                         total_tiles: int, on_identified, poll_interval: int = 30) -> list:
+    """Identify all pending tiles with a single Message Batches job.
+
+    Batches are billed at half the interactive rate and are not subject to
+    per-request latency, at the cost of waiting for the batch to finish. The
+    batch ID is kept in sprites.batch until its results are collected, so an
+    interrupted run re-attaches to the same batch instead of submitting again,
+    as long as it was submitted for the same tiles.
+    `on_identified(index, sprite_data)` is called for each tile that succeeds.
+    Returns the sprite data in the same order as `pending`, with None for
+    tiles that failed to identify.
+    """
+    # Record which tile each request was made for so a later run can tell
+    # whether the batch still matches the tiles it needs
+    request_keys = {f"{y}_{x}": tile_cache_key(tile) for x, y, tile in pending}
+
+    batch = None
+    batch_id = load_batch_id(request_keys)
+    if batch_id is not None:
+        # A previous run submitted this batch but did not collect its results
+        try:
+            batch = await retrieve_batch(client, batch_id)
+            print(f"   Re-attaching to batch {batch.id}")
+        except anthropic.NotFoundError:
+            print(f"   ⚠ Batch {batch_id} no longer exists, submitting a new one")
+
+    if batch is None:
+        batch = await create_batch(client, [
+            {"custom_id": f"{y}_{x}", "params": build_message_params(tile, x, y)}
+            for x, y, tile in pending
+        ])
+        with open(BATCH_PATH, 'w') as f:
+            json.dump({"batchId": batch.id, "requests": request_keys}, f)
+        print(f"   Submitted batch {batch.id} ({len(pending)} requests)")
+
+    while batch.processing_status != "ended":
+        await asyncio.sleep(poll_interval)
+        batch = await retrieve_batch(client, batch.id)
+        counts = batch.request_counts
+        print(f"   ... {batch.processing_status}: {counts.succeeded} succeeded, "
+              f"{counts.errored} errored, {counts.processing} processing")
+
+    results = await fetch_batch_results(client, batch.id)
 
-    # Parse response
-    response_text = message.content[0].text.strip()
+    sprites = []
+    for index, (x, y, _) in enumerate(pending):
+        tile_num = y * grid_width + x
+        result = results.get(f"{y}_{x}")
+        sprite_data = None
+        try:
+            if result is None or result.type != "succeeded":
+                raise RuntimeError(result.type if result is not None else "missing from results")
 
-    # Extract JSON from response (Claude might wrap it in markdown code blocks)
-    if response_text.startswith('```'):
-        # Remove markdown code blocks
-        lines = response_text.split('\n')
-        response_text = '\n'.join(lines[1:-1])
+            parsed = parse_sprite(result.message)
+            on_identified(index, parsed)
+            print(f"   [{tile_num + 1}/{total_tiles}] ({x}, {y}) ✓ {parsed['id']}")
+            sprite_data = parsed
 
-    return json.loads(response_text)
+        except Exception as e:
+            print(f"   [{tile_num + 1}/{total_tiles}] ({x}, {y}) ✗ Error: {e}")
 
-def main():
-    if len(sys.argv) != 2:
-        print("Usage: python identify_tiles.py tileset_config.yaml")
-        sys.exit(1)
+        # Exactly one entry per pending tile so results line up with `pending`
+        sprites.append(sprite_data)
 
-    config_path = sys.argv[1]
+    BATCH_PATH.unlink(missing_ok=True)
+    return sprites
+
+def main():
+    parser = argparse.ArgumentParser(description="Identify tileset sprites with Claude's vision API")
+    parser.add_argument("config", help="tileset YAML config")
+    parser.add_argument("--batch", action="store_true",
+                        help="submit all tiles as one Message Batches job (half price, higher latency)")
+    parser.add_argument("--debug-dump", action="store_true",
+                        help="write each non-empty tile to tiles/tile_<y>_<x>.png")
+    parser.add_argument("--upload-files", action="store_true",
+                        help="upload tiles through the Files API instead of sending them inline as base64")
+    args = parser.parse_args()
+    if args.batch and args.upload_files:
+        parser.error("--upload-files cannot be combined with --batch")
+
+    try:
+        concurrency = int(os.getenv("CONCURRENCY", 8))
+    except ValueError:
+        parser.error(f"CONCURRENCY must be an integer, got {os.getenv('CONCURRENCY')!r}")
+    if concurrency < 1:
+        parser.error(f"CONCURRENCY must be at least 1, got {concurrency}")
+
+    config_path = args.config
 
     # Load configuration
     print(f"📂 Loading config from {config_path}...")
@@ -139,60 +600,128 @@ def main():
     print(f"   Tile size: {tile_size}x{tile_size}")
     print(f"   Grid: {grid_width}x{grid_height} ({grid_width * grid_height} tiles)")
 
-    # Load tileset image
-    tileset = Image.open(image_path)
-
-    # Initialize Anthropic client
-    client = Anthropic()
+    # Load tileset image; tiles are sliced out of this array as views
+    full = np.asarray(Image.open(image_path).convert('RGBA'))
+    if full.shape[0] < grid_height * tile_size or full.shape[1] < grid_width * tile_size:
+        print(f"   ⚠ Image is {full.shape[1]}x{full.shape[0]}, padding to the grid with transparent pixels")
+        full = pad_to_grid(full, tile_size, grid_width, grid_height)
+
+    # Initialize Anthropic client (retries are handled by identify_sprite). Concurrent
+    # requests are multiplexed over a persistent HTTP/2 connection instead of
+    # paying a TLS handshake whenever the pool recycles a connection.
+    if not HTTP2_AVAILABLE:
+        print("⚠ h2 is not installed (pip install 'httpx[http2]'), falling back to HTTP/1.1")
+    client = AsyncAnthropic(
+        max_retries=0,
+        http_client=anthropic.DefaultAsyncHttpxClient(http2=HTTP2_AVAILABLE, timeout=60),
+    )
 
-    # Process each tile
-    sprites = []
+    # Collect non-empty tiles up front so they can be dispatched concurrently
     total_tiles = grid_width * grid_height
-    processed = 0
-    skipped = 0
+    pending = []
 
     print(f"\n🔍 Analyzing tiles...")
 
-    for y in range(grid_height):
-        for x in range(grid_width):
-            tile_num = y * grid_width + x
-            print(f"   [{tile_num + 1}/{total_tiles}] Processing tile at ({x}, {y})...", end=' ')
-
-            # Extract tile
-            tile = extract_tile(tileset, x, y, tile_size)
-            tile.save(f"tiles/tile_{y}_{x}.png")
-
-            # Skip empty tiles
-            if is_empty_tile(tile):
-                print("⊘ Empty, skipping")
-                skipped += 1
-                continue
-
-            # Identify sprite using Claude
-            try:
-                sprite_data = identify_sprite(client, tile, x, y)
-
-                # Add grid position
-                sprite_data['gridX'] = x
-                sprite_data['gridY'] = y
-
-                sprites.append(sprite_data)
-                processed += 1
+    # Tile dumps are written in the background so PNG encoding overlaps the API calls
+    dump_pool = None
+    dumps = []
+    if args.debug_dump:
+        Path("tiles").mkdir(exist_ok=True)
+        dump_pool = ThreadPoolExecutor(max_workers=4)
+
+    # Skip empty tiles
+    empty = find_empty_tiles(full, tile_size, grid_width, grid_height)
+    skipped = int(empty.sum())
+
+    for y, x in zip(*np.nonzero(~empty)):
+        x, y = int(x), int(y)
+
+        # Extract tile
+        tile = extract_tile(full, x, y, tile_size)
+        if dump_pool:
+            path = f"tiles/tile_{y}_{x}.png"
+            dumps.append((path, dump_pool.submit(save_tile, tile, path)))
+
+        pending.append((x, y, tile))
+
+    # Reuse identifications from previous runs and group tiles with identical
+    # pixels so each unique sprite is only sent to Claude once
+    done = load_progress()
+    results = {}
+    misses = []
+    duplicates = {}
+    resumed = 0
+    for x, y, tile in pending:
+        key = tile_cache_key(tile)
+
+        # Only trust a recorded sprite if it was made for these exact pixels and prompt;
+        # a leftover progress file may come from a different tileset or grid
+        sprite_data = done.get((x, y))
+        if sprite_data is not None and sprite_data.get('tileKey') == key:
+            results[(x, y)] = sprite_data
+            resumed += 1
+            continue
+
+        if key in duplicates:
+            duplicates[key].append((x, y))
+            continue
+
+        sprite_data = load_cached_sprite(key)
+        if sprite_data is not None:
+            results[(x, y)] = sprite_data
+        else:
+            misses.append((x, y, tile, key))
+            duplicates[key] = [(x, y)]
+
+    print(f"   {len(pending)} non-empty tiles, {skipped} empty tiles skipped, {resumed} resumed, "
+          f"{len(results) - resumed} cached, {len(misses)} unique to identify")
+
+    with open(PROGRESS_PATH, 'a') as progress:
+        def record(index: int, sprite_data: dict):
+            """Cache a new identification and append it to the progress file."""
+            key = misses[index][3]
+            save_cached_sprite(key, sprite_data)
+            for x, y in duplicates[key]:
+                progress.write(json.dumps({**sprite_data, 'gridX': x, 'gridY': y, 'tileKey': key}) + '\n')
+            progress.flush()
+
+        to_identify = [(x, y, tile) for x, y, tile, _ in misses]
+        if not to_identify:
+            identified = []
+        elif args.batch:
+            identified = asyncio.run(identify_batch(client, to_identify, grid_width, total_tiles, record))
+        else:
+            print(f"   Dispatching with concurrency {concurrency}")
+
+            identified = asyncio.run(identify_all(client, to_identify, grid_width, total_tiles, concurrency, record,
+                                                  upload_files=args.upload_files))
+
+    if dump_pool:
+        dump_pool.shutdown()
+        for path, future in dumps:
+            if future.exception() is not None:
+                print(f"   ⚠ Could not write {path}: {future.exception()}")
+
+    failed = 0
+    for (_, _, _, key), sprite_data in zip(misses, identified):
+        for x, y in duplicates[key]:
+            if sprite_data is None:
+                # Add placeholder for failed tiles
+                results[(x, y)] = failed_sprite(x, y, y * grid_width + x)
+                failed += 1
+            else:
+                results[(x, y)] = sprite_data
 
-                print(f"✓ {sprite_data['id']}")
+    sprites = []
+    for x, y, _ in pending:
+        # Add grid position
+        sprite_data = dict(results[(x, y)])
+        sprite_data.pop('tileKey', None)
+        sprite_data['gridX'] = x
+        sprite_data['gridY'] = y
+        sprites.append(sprite_data)
 
-            except Exception as e:
-                print(f"✗ Error: {e}")
-                # Add placeholder for failed tiles
-                sprites.append({
-                    "id": f"tile_{y}_{x}",
-                    "name": f"Tile {tile_num}",
-                    "description": "Failed to identify",
-                    "type": "other",
-                    "walkable": False,
-                    "gridX": x,
-                    "gridY": y
-                })
+    processed = len(sprites) - failed
 
     # Save results
     output_path = "sprites.json"
@@ -206,6 +735,9 @@ def main():
             "sprites": sprites
         }, f, indent=2)
 
+    # The manifest is complete, so there is nothing left to resume
+    PROGRESS_PATH.unlink(missing_ok=True)
+
     print(f"\n✅ Done!")
     print(f"   Processed: {processed} tiles")
     print(f"   Skipped: {skipped} empty tiles")